@@ -1,6 +1,8 @@
 # !/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import asyncio
+import functools
 import logging
 import math
 import socket
@@ -137,13 +139,14 @@ class BpodBase(object):
         logger.info("Starting Bpod")
         self._bpodcom_connect(self.serial_port, self.secondary_serial_port, self.analog_serial_port, self.baudrate)
         
-        if not self._bpodcom_handshake():
+        handshake_ok, firmware_version, machine_type = self._bpodcom_handshake_and_firmware_version()
+
+        if not handshake_ok:
             raise BpodErrorException('Error: Bpod failed to confirm connectivity. Please reset Bpod and try again.')
 
         #########################################################
         ### check the firmware version ##############################
         #########################################################
-        firmware_version, machine_type = self._bpodcom_firmware_version()
 
         if firmware_version < int(settings.TARGET_BPOD_FIRMWARE_VERSION):
             raise BpodErrorException('Error: Old firmware detected. Please update Bpod 0.7+ firmware and try again.')
@@ -180,6 +183,8 @@ class BpodBase(object):
 
             if not self._bpodcom_handshake_analog():
                 raise BpodErrorException('Error: Bpod r2+ analog serial port failed to confirm connectivity. Please reset Bpod and try again.')
+
+            self._bpodcom_start_analog_reader()
         
         self._hardware.setup(self.bpod_modules)
 
@@ -405,14 +410,14 @@ class BpodBase(object):
         elif inline.startswith('trigger_input:'):
             tdata = inline.split(':')
             chn_name = tdata[1]
-            evt_data = tdata[2]
+            evt_data = int(tdata[2])
             # TODO: surround this call in a try except to capture calls with unavailable channel names
             channel_number = sma.hardware.channels.input_channel_names.index(chn_name)
             self.trigger_input(channel_number, evt_data)
         elif inline.startswith('trigger_output:'):
             tdata = inline.split(':')
             chn_name = tdata[1]
-            evt_data = tdata[2]
+            evt_data = int(tdata[2])
             # TODO: surround this call in a try except to capture calls with unavailable channel names
             channel_number = sma.hardware.channels.output_channel_names.index(chn_name)
             self.trigger_output(channel_number, evt_data)
@@ -606,12 +611,7 @@ class BpodBase(object):
         :param int value: Disabled = 0, Enabled = 1.
         """
         if self._hardware.machine_type > 3:
-            if (channel < 1) or (channel > self._hardware.n_flex_channels):
-                raise BpodErrorException("Error: Invalid flex channel number.")
-            if (threshold < 1) or (threshold > 2):
-                raise BpodErrorException("Error: Invalid threshold number.")
-            if (value < 0) or (value > 1):
-                raise BpodErrorException("Error: Enable value must be either 0 or 1.")
+            self.__check_analog_input_threshold(channel, threshold, value)
             
             if not self._bpodcom_enable_analog_input_threshold(channel - 1, threshold - 1, value):  # subtract one to get the index
                 raise BpodErrorException("Error: Failed to enable analog input threshold.")
@@ -619,7 +619,42 @@ class BpodBase(object):
         else:
             raise BpodErrorException("Error: Bpod hardware is not compatible. Only Bpod version r2+ contains the required Flex I/O channels to configure analog input.")
 
-    def read_analog_input(self):
+    def enable_analog_input_thresholds(self, thresholds):
+        """
+        Enable several analog input thresholds at once. Compatible only with Bpod r2+ (machine type 4).
+        The commands are sent back to back and their confirmations are read together, which is faster than calling
+        :meth:`enable_analog_input_threshold` for each of them.
+
+        :param list[tuple(int, int, int)] thresholds: (channel, threshold, value) for each threshold to set, with the same
+            meaning as the arguments of :meth:`enable_analog_input_threshold`.
+        """
+        if self._hardware.machine_type > 3:
+            for channel, threshold, value in thresholds:
+                self.__check_analog_input_threshold(channel, threshold, value)
+
+            try:
+                for channel, threshold, value in thresholds:
+                    self._bpodcom_enable_analog_input_threshold_nowait(channel - 1, threshold - 1, value)  # subtract one to get the index
+            except Exception:
+                # The replies of the commands already sent will not be collected, so do not block the next commands on them.
+                self._bpodcom_discard_replies()
+                raise
+
+            if not all(self._bpodcom_flush_replies()):
+                raise BpodErrorException("Error: Failed to enable analog input threshold.")
+
+        else:
+            raise BpodErrorException("Error: Bpod hardware is not compatible. Only Bpod version r2+ contains the required Flex I/O channels to configure analog input.")
+
+    def __check_analog_input_threshold(self, channel, threshold, value):
+        if (channel < 1) or (channel > self._hardware.n_flex_channels):
+            raise BpodErrorException("Error: Invalid flex channel number.")
+        if (threshold < 1) or (threshold > 2):
+            raise BpodErrorException("Error: Invalid threshold number.")
+        if (value < 0) or (value > 1):
+            raise BpodErrorException("Error: Enable value must be either 0 or 1.")
+
+    def read_analog_input(self, timeout=0):
         """
         While running a trial, any channels configured as analog inputs return samples to the PC via the analog serial port.
         The data format on that port is: [TrialNumber, uint16] [Sample Ch0, uint16]...[Sample ChN, uint16].
@@ -628,14 +663,30 @@ class BpodBase(object):
         [TrialNumber] [Sample1 from Ch2] [Sample1 from Ch4] [TrialNumber] [Sample2 from Ch2] [Sample2 from Ch4]...etc.
         TrialNumber is reset at the beginning of each behavior session with op '*' on the state machine's primary port.
 
-        :return: List of samples for each analog input channel in uint16, including trial number with each sample.
-        :rtype list[int]:
+        :param float timeout: seconds to wait for at least one sample when none was received yet (0 returns immediately,
+            None waits indefinitely).
+        :return: trial numbers, of shape (n_samples,), and samples, of shape (n_samples, n_channels), as uint16 arrays.
+            Both are views over the received bytes, so no data is copied; e.g. frame.samples[:, k] holds channel k.
+        :rtype pybpodapi.bpod.bpod_com_protocol.SamplesFrame:
         """
         if self._hardware.machine_type > 3:
-            return self._bpodcom_read_analog_input_samples(len(self._hardware.analog_input_channels))
+            return self._bpodcom_read_analog_input_samples(len(self._hardware.analog_input_channels), timeout)
         else:
             raise BpodErrorException("Error: Bpod hardware is not compatible. Only Bpod version r2+ contains the required Flex I/O channels to configure analog input.")
 
+    async def read_analog_input_async(self, timeout=1):
+        """
+        Coroutine version of :meth:`read_analog_input`, to await analog input samples from an asyncio event loop
+        (e.g. together with other I/O through ``asyncio.gather``) without blocking it. The wait runs in the loop's default executor.
+
+        :param float timeout: seconds to wait for at least one sample when none was received yet (None waits indefinitely,
+            which keeps a thread of the loop's default executor busy until a sample arrives or the Bpod is closed).
+        :return: trial numbers and samples, as returned by :meth:`read_analog_input`.
+        :rtype pybpodapi.bpod.bpod_com_protocol.SamplesFrame:
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(self.read_analog_input, timeout))
+
 
     #########################################
     ############ PRIVATE METHODS ############
@@ -784,8 +835,7 @@ class BpodBase(object):
         if self.hardware.live_timestamps:
             timestamps = self.trial_timestamps
         else:
-            timestamps = self._bpodcom_read_alltimestamps()
-            timestamps = [float(t)*self._hardware.times_scale_factor for t in timestamps]
+            timestamps = self._bpodcom_read_alltimestamps().tolist()
 
             # update the timestamps of the events #############################################################
             for event, timestamp in zip(current_trial.events_occurrences, timestamps):
@@ -1,20 +1,87 @@
 # !/usr/bin/python3
 # -*- coding: utf-8 -*-
 
+import json
 import logging
+import os
+import struct
+import threading
+import time
+from collections import Counter, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import serial.tools.list_ports
 from serial.serialutil import SerialException
 
 from confapp import conf as settings
 from pybpodapi.bpod.bpod_base import BpodBase
 from pybpodapi.bpod.hardware.channels import ChannelType
-from pybpodapi.bpod_modules.bpod_module import BpodModule
-from pybpodapi.com.arcom import ArCOM, ArduinoTypes
+from pybpodapi.com.arcom import ArCOM
 from pybpodapi.com.protocol.recv_msg_headers import ReceiveMessageHeader
 from pybpodapi.com.protocol.send_msg_headers import SendMessageHeader
 from pybpodapi.exceptions.bpod_error import BpodErrorException
 
 logger = logging.getLogger(__name__)
 
+# USB (VID, PID) pairs of the Teensy microcontroller used by the Bpod r2+, the only Bpod whose serial ports are identified
+# automatically. Only these ports are tested when identifying the Bpod serial ports, so that unrelated devices (which may
+# block for a long time when opened) are skipped.
+BPOD_USB_IDS = {
+    (0x16C0, 0x0483),  # Teensy, serial
+    (0x16C0, 0x048B),  # Teensy, dual serial
+    (0x16C0, 0x048C),  # Teensy, triple serial (Bpod r2+)
+}
+
+# Analog input samples read from the analog serial port. Both fields are views over the same received buffer (no copy):
+#   trial: array of shape (n_samples,) with the trial number of each sample
+#   samples: array of shape (n_samples, n_channels) with the samples of each analog input channel, in rank order
+SamplesFrame = namedtuple("SamplesFrame", ["trial", "samples"])
+
+# Driver buffer sizes requested for the analog port (Windows only, see ArCOM.set_buffer_size), large enough to hold
+# bursts of streamed samples between two reads.
+ANALOG_RX_BUFFER_SIZE = 1 << 20
+ANALOG_TX_BUFFER_SIZE = 1 << 16
+
+# Read timeout of the analog port while the background reader is running. It bounds how long stopping the reader takes.
+ANALOG_READER_TIMEOUT = 0.01
+
+# Maximum number of analog port bytes kept by the background reader until they are read. When it is exceeded (i.e. the
+# samples are not read often enough, or at all), the oldest whole sample frames are dropped.
+ANALOG_BUFFER_MAX_SIZE = 1 << 24
+
+# Op codes as integers, so that packets can be built without calling ord() on every command.
+_OP_HANDSHAKE = ord(SendMessageHeader.HANDSHAKE)
+_OP_FIRMWARE_VERSION = ord(SendMessageHeader.FIRMWARE_VERSION)
+_OP_GET_TIMESTAMP_TRANSMISSION = ord(SendMessageHeader.GET_TIMESTAMP_TRANSMISSION)
+_OP_HARDWARE_DESCRIPTION = ord(SendMessageHeader.HARDWARE_DESCRIPTION)
+_OP_PAUSE_TRIAL = ord(SendMessageHeader.PAUSE_TRIAL)
+_OP_ENABLE_PORTS = ord(SendMessageHeader.ENABLE_PORTS)
+_OP_SYNC_CHANNEL_MODE = ord(SendMessageHeader.SYNC_CHANNEL_MODE)
+_OP_ECHO_SOFTCODE = ord(SendMessageHeader.ECHO_SOFTCODE)
+_OP_MANUAL_OVERRIDE_EXEC_EVENT = ord(SendMessageHeader.MANUAL_OVERRIDE_EXEC_EVENT)
+_OP_TRIGGER_SOFTCODE = ord(SendMessageHeader.TRIGGER_SOFTCODE)
+_OP_LOAD_SERIAL_MESSAGE = ord(SendMessageHeader.LOAD_SERIAL_MESSAGE)
+_OP_OVERRIDE_DIGITAL_HW_STATE = ord(SendMessageHeader.OVERRIDE_DIGITAL_HW_STATE)
+_OP_SEND_TO_HW_SERIAL = ord(SendMessageHeader.SEND_TO_HW_SERIAL)
+_OP_SET_ANALOG_INPUT_SAMPLING_INTERVAL = ord(SendMessageHeader.SET_ANALOG_INPUT_SAMPLING_INTERVAL)
+_OP_SET_ANALOG_INPUT_THRESHOLDS = ord(SendMessageHeader.SET_ANALOG_INPUT_THRESHOLDS)
+_OP_SET_FLEX_CHANNEL_TYPES = ord(SendMessageHeader.SET_FLEX_CHANNEL_TYPES)
+_OP_SET_ANALOG_INPUT_THRESHOLD_POLARITY = ord(SendMessageHeader.SET_ANALOG_INPUT_THRESHOLD_POLARITY)
+_OP_SET_ANALOG_INPUT_THRESHOLD_MODE = ord(SendMessageHeader.SET_ANALOG_INPUT_THRESHOLD_MODE)
+_OP_ENABLE_ANALOG_INPUT_THRESHOLD = ord(SendMessageHeader.ENABLE_ANALOG_INPUT_THRESHOLD)
+
+# Precompiled packers for the fixed size commands and unpackers for the timestamps read during a trial.
+_PACK_2B = struct.Struct("<2B").pack
+_PACK_3B = struct.Struct("<3B").pack
+_PACK_4B = struct.Struct("<4B").pack
+_PACK_SAMPLING_INTERVAL = struct.Struct("<BI").pack
+_UNPACK_UINT16 = struct.Struct("<H").unpack
+_UNPACK_UINT64 = struct.Struct("<Q").unpack
+_UNPACK_TRIAL_END_TIMESTAMPS = struct.Struct("<IQ").unpack
+
+# Secondary and analog serial port handshake requests, sent together as a single write during port identification.
+_HANDSHAKE_PAIR = bytes([ord(SendMessageHeader.SECONDARY_PORT_HANDSHAKE), ord(SendMessageHeader.ANALOG_PORT_HANDSHAKE)])
+
 
 class BpodCOMProtocol(BpodBase):
     """
@@ -37,10 +104,23 @@ class BpodCOMProtocol(BpodBase):
         self._arcom = None  # type: ArCOM
         self._arcom_secondary = None  # type: ArCOM
         self._arcom_analog = None  # type: ArCOM
+        self._analog_reader = None  # type: threading.Thread
+        self._analog_reader_stop = threading.Event()
+        self._analog_buffer = bytearray()  # analog port bytes received by the reader and not yet returned as samples
+        self._analog_buffer_condition = threading.Condition()  # guards _analog_buffer and signals new bytes from the reader
+        self._analog_buffer_overflowed = False  # whether samples were dropped because _analog_buffer was full
         self.bpod_com_ready = False
 
-        # used to keep the list of msg ids sent using the load_serial_message function
-        self.msg_id_list = [False for i in range(255)]
+        # confirmation bytes expected for the commands sent without waiting for their reply (see _bpodcom_flush_replies)
+        self._pending_replies = deque()
+
+        # bitmap of the msg ids sent using the load_serial_message function (bit message_id is set once loaded)
+        self.msg_id_bitmap = bytearray(32)
+
+        # time conversion factors, cached once the hardware description is received (see _bpodcom_hardware_description)
+        self._times_scale = None  # type: float
+        self._freq_div = None  # type: float
+        self._cycle_freq = None  # type: float
 
         if self.serial_port:
             # When self.serial_port is given (either in the settings file or during Bpod object init),
@@ -68,6 +148,7 @@ class BpodCOMProtocol(BpodBase):
             if self._arcom_secondary is not None:
                 self._arcom_secondary.close()
             if self._arcom_analog is not None:
+                self._bpodcom_stop_analog_reader()
                 self._arcom_analog.close()
             self.bpod_com_ready = False
 
@@ -82,25 +163,25 @@ class BpodCOMProtocol(BpodBase):
         """
         if channel_type == ChannelType.INPUT:
             input_channel_name = channel_name + str(channel_number)
-            channel_number = self.hardware.channels.input_channel_names.index(input_channel_name)
             try:
-                self._bpodcom_override_input_state(channel_number, value)
-            except:
+                channel_number = self.hardware.channels.input_channel_indexes[input_channel_name]
+            except KeyError:
                 raise BpodErrorException(
-                    'Error using manual_override: {name} is not a valid channel name.'.format(name=channel_name))
+                    'Error using manual_override: {name} is not a valid channel name.'.format(name=input_channel_name))
+            self._bpodcom_override_input_state(channel_number, value)
 
         elif channel_type == ChannelType.OUTPUT:
             if channel_name == 'Serial':
                 self._bpodcom_send_byte_to_hardware_serial(channel_number, value)
 
             else:
+                output_channel_name = channel_name + str(channel_number)
                 try:
-                    output_channel_name = channel_name + str(channel_number)
-                    channel_number = self.hardware.channels.output_channel_names.index(output_channel_name)
-                    self._bpodcom_override_digital_hardware_state(channel_number, value)
-                except:
+                    channel_number = self.hardware.channels.output_channel_indexes[output_channel_name]
+                except KeyError:
                     raise BpodErrorException('Error using manual_override: {name} is not a valid channel name.'.format(
                         name=output_channel_name))
+                self._bpodcom_override_digital_hardware_state(channel_number, value)
         else:
             raise BpodErrorException('Error using manualOverride: first argument must be "Input" or "Output".')
 
@@ -116,21 +197,45 @@ class BpodCOMProtocol(BpodBase):
         """
         logger.debug("Connecting on port: %s", serial_port)
         self._arcom = ArCOM().open(serial_port, baudrate, timeout)
-
-        if secondary_port:
+        self._arcom.set_low_latency()
+
+        if secondary_port and analog_port:
+            # Opening a port blocks while the driver configures it, so open both Bpod r2+ extra ports concurrently.
+            logger.debug("Connecting to secondary port on %s and analog port on %s", secondary_port, analog_port)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                secondary_future = executor.submit(ArCOM().open, secondary_port, baudrate, timeout)
+                analog_future = executor.submit(ArCOM().open, analog_port, baudrate, timeout)
+
+            # If one of the ports failed to open, close the other one before re-raising, since it would be left open.
+            errors = [future.exception() for future in (secondary_future, analog_future)]
+            if any(errors):
+                for future, error in zip((secondary_future, analog_future), errors):
+                    if error is None:
+                        future.result().close()
+                raise next(error for error in errors if error is not None)
+
+            self._arcom_secondary = secondary_future.result()
+            self._arcom_analog = analog_future.result()
+
+        elif secondary_port:
             logger.debug("Connecting to secondary port on %s", secondary_port)
             self._arcom_secondary = ArCOM().open(secondary_port, baudrate, timeout)
 
-        if analog_port:
+        elif analog_port:
             logger.debug("Connecting to analog port on %s", analog_port)
             self._arcom_analog = ArCOM().open(analog_port, baudrate, timeout)
 
+        if self._arcom_analog is not None:
+            self._arcom_analog.set_low_latency()
+            self._arcom_analog.set_buffer_size(rx_size=ANALOG_RX_BUFFER_SIZE, tx_size=ANALOG_TX_BUFFER_SIZE)
+
     def _bpodcom_disconnect(self):
         """
         Signal Bpod device to disconnect now
         """
         logger.debug("Requesting disconnect ('%s')", SendMessageHeader.DISCONNECT)
 
+        self._bpodcom_check_no_pending_replies()
         self._arcom.write_char(SendMessageHeader.DISCONNECT)
 
         res = self._arcom.read_char() == ReceiveMessageHeader.DISCONNECT_OK
@@ -141,21 +246,73 @@ class BpodCOMProtocol(BpodBase):
     # def __bpodcom_check_com_ready(self):
     #    if not self.bpod_com_ready: self.open()
 
-    def _bpodcom_handshake(self):
+    def _bpodcom_pipeline(self, commands):
         """
-        Test connectivity by doing an handshake
+        Send several independent commands in a single write and only then collect their replies,
+        so that the whole sequence costs one serial round trip instead of one per command.
 
-        :return: True if handshake received, False otherwise
+        :param list(tuple(bytes, int)) commands: pairs of (packet to send, number of bytes in the reply)
+        :return: replies, in the same order as the commands. Replies are shorter than expected if Bpod stopped responding.
+        :rtype: list(bytes)
+        """
+        self._bpodcom_check_no_pending_replies()
+        self._arcom.write_array(b"".join(packet for packet, _ in commands))
+
+        data = self._arcom.read_exactly(sum(reply_size for _, reply_size in commands))
+
+        replies = []
+        position = 0
+        for _, reply_size in commands:
+            replies.append(data[position:position + reply_size])
+            position += reply_size
+
+        return replies
+
+    def _bpodcom_write_and_confirm(self, packet, ok_response):
+        """
+        Send a command to the primary port and read its one byte confirmation.
+
+        :param bytes packet: command op code followed by its arguments
+        :param int ok_response: confirmation byte expected when the command succeeds
+        :return: True if the received confirmation is ok_response, False otherwise
         :rtype: bool
         """
+        self._bpodcom_check_no_pending_replies()
+        self._arcom.write_array(packet)
 
-        logger.debug("Requesting handshake ('%s')", SendMessageHeader.HANDSHAKE)
-        self._arcom.write_char(SendMessageHeader.HANDSHAKE)
+        response = self._arcom.read_uint8()  # type: int
+        logger.debug("Response: %s", response)
+
+        return response == ok_response
+
+    def _bpodcom_handshake_and_firmware_version(self):
+        """
+        Do the handshake and request the firmware and machine type from Bpod in a single round trip
+
+        :return: True if handshake received (False otherwise), firmware version and machine type
+        :rtype: bool, int, int
+        """
+        logger.debug("Requesting handshake ('%s') and firmware version ('%s')",
+                     SendMessageHeader.HANDSHAKE, SendMessageHeader.FIRMWARE_VERSION)
 
-        response = self._arcom.read_char()  # Receive response
-        logger.debug("Response command is: '%s'", response)
+        handshake, versions = self._bpodcom_pipeline([
+            (bytes([_OP_HANDSHAKE]), 1),
+            (bytes([_OP_FIRMWARE_VERSION]), 4),
+        ])
+        logger.debug("Response command is: '%s'", handshake)
+
+        if handshake != ReceiveMessageHeader.HANDSHAKE_OK.encode():
+            return False, None, None
+
+        if len(versions) < 4:
+            raise BpodErrorException("Error: Bpod did not report its firmware version. Please reset Bpod and try again.")
+
+        fw_version, machine_type = struct.unpack("<HH", versions)
+
+        logger.debug("Firmware version: %s", fw_version)
+        logger.debug("Machine type: %s", machine_type)
 
-        return response == ReceiveMessageHeader.HANDSHAKE_OK
+        return True, fw_version, machine_type
 
     def _bpodcom_handshake_secondary(self):
         """
@@ -167,6 +324,7 @@ class BpodCOMProtocol(BpodBase):
         """
         
         logger.debug("Requesting handshake for secondary serial port ('%s')", SendMessageHeader.SECONDARY_PORT_HANDSHAKE)
+        self._bpodcom_check_no_pending_replies()
         self._arcom.write_char(SendMessageHeader.SECONDARY_PORT_HANDSHAKE)  # Send from the primary serial port.
 
         response = self._arcom_secondary.read_uint8()  # Read from the secondary serial port.
@@ -184,6 +342,7 @@ class BpodCOMProtocol(BpodBase):
         """
         
         logger.debug("Requesting handshake for analog serial port ('%s')", SendMessageHeader.ANALOG_PORT_HANDSHAKE)
+        self._bpodcom_check_no_pending_replies()
         self._arcom.write_char(SendMessageHeader.ANALOG_PORT_HANDSHAKE)  # Send from the primary serial port.
 
         response = self._arcom_analog.read_uint8()  # Read from the analog serial port.
@@ -191,32 +350,13 @@ class BpodCOMProtocol(BpodBase):
 
         return response == ReceiveMessageHeader.ANALOG_PORT_HANDSHAKE_OK
     
-    def _bpodcom_firmware_version(self):
-        """
-        Request firmware and machine type from Bpod
-
-        :return: firmware and machine type versions
-        :rtype: int, int
-        """
-
-        logger.debug("Requesting firmware version ('%s')", SendMessageHeader.FIRMWARE_VERSION)
-
-        self._arcom.write_char(SendMessageHeader.FIRMWARE_VERSION)
-
-        fw_version = self._arcom.read_uint16()  # type: int
-        machine_type = self._arcom.read_uint16()  # type: int
-
-        logger.debug("Firmware version: %s", fw_version)
-        logger.debug("Machine type: %s", machine_type)
-
-        return fw_version, machine_type
-
     def _bpodcom_reset_clock(self):
         """
         Reset session clock
         """
         logger.debug("Resetting clock")
 
+        self._bpodcom_check_no_pending_replies()
         self._arcom.write_char(SendMessageHeader.RESET_CLOCK)
         return self._arcom.read_uint8() == ReceiveMessageHeader.RESET_CLOCK_OK
 
@@ -232,7 +372,7 @@ class BpodCOMProtocol(BpodBase):
         Pause ongoing trial (We recommend using computer-side pauses between trials, to keep data uniform)
         """
         logger.debug("Pausing trial")
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.PAUSE_TRIAL), 0])
+        bytes2send = _PACK_2B(_OP_PAUSE_TRIAL, 0)
         self._arcom.write_array(bytes2send)
 
     def _bpodcom_resume_trial(self):
@@ -240,18 +380,9 @@ class BpodCOMProtocol(BpodBase):
         Resumes ongoing trial (We recommend using computer-side pauses between trials, to keep data uniform)
         """
         logger.debug("Resume trial")
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.PAUSE_TRIAL), 1])
+        bytes2send = _PACK_2B(_OP_PAUSE_TRIAL, 1)
         self._arcom.write_array(bytes2send)
 
-    def _bpodcom_get_timestamp_transmission(self):
-        """
-        Return timestamp transmission scheme
-        """
-        logger.debug("Get timestamp transmission")
-
-        self._arcom.write_char(SendMessageHeader.GET_TIMESTAMP_TRANSMISSION)
-        return self._arcom.read_byte()
-
     def _bpodcom_hardware_description(self, hardware):
         """
         Request hardware description from Bpod
@@ -260,42 +391,49 @@ class BpodCOMProtocol(BpodBase):
         """
 
         logger.debug("Requesting hardware description ('%s')...", SendMessageHeader.HARDWARE_DESCRIPTION)
-        self._arcom.write_char(SendMessageHeader.HARDWARE_DESCRIPTION)
 
-        max_states = self._arcom.read_uint16()  # type: int
-        logger.debug("Read max states: %s", max_states)
+        self._bpodcom_check_no_pending_replies()
 
-        cycle_period = self._arcom.read_uint16()  # type: int
-        logger.debug("Read cycle period: %s", cycle_period)
+        # Request the timestamp transmission scheme in the same write; its reply follows the hardware description.
+        self._arcom.write_array(bytes([_OP_HARDWARE_DESCRIPTION, _OP_GET_TIMESTAMP_TRANSMISSION]))
 
-        max_serial_events = self._arcom.read_uint8()  # type: int
-        logger.debug("Read number of events per serial channel: %s", max_serial_events)
+        if hardware.firmware_version > 22:
+            header_format = "<HHBBBBBB"
+        else:
+            header_format = "<HHBBBBB"
+        header_size = struct.calcsize(header_format)
+
+        header = self._bpodcom_read_exactly(header_size)
 
         if hardware.firmware_version > 22:
-            serial_message_max_bytes = self._arcom.read_uint8()  # type: int
-            logger.debug("Read max number of bytes allowed per serial message: %s", serial_message_max_bytes)
+            max_states, cycle_period, max_serial_events, serial_message_max_bytes, \
+                n_global_timers, n_global_counters, n_conditions, n_inputs = struct.unpack(header_format, header)
         else:
+            max_states, cycle_period, max_serial_events, \
+                n_global_timers, n_global_counters, n_conditions, n_inputs = struct.unpack(header_format, header)
             serial_message_max_bytes = 3
-        
-        n_global_timers = self._arcom.read_uint8()  # type: int
-        logger.debug("Read number of global timers: %s", n_global_timers)
 
-        n_global_counters = self._arcom.read_uint8()  # type: int
+        logger.debug("Read max states: %s", max_states)
+        logger.debug("Read cycle period: %s", cycle_period)
+        logger.debug("Read number of events per serial channel: %s", max_serial_events)
+        logger.debug("Read max number of bytes allowed per serial message: %s", serial_message_max_bytes)
+        logger.debug("Read number of global timers: %s", n_global_timers)
         logger.debug("Read number of global counters: %s", n_global_counters)
-
-        n_conditions = self._arcom.read_uint8()  # type: int
         logger.debug("Read number of conditions: %s", n_conditions)
-
-        n_inputs = self._arcom.read_uint8()  # type: int
         logger.debug("Read number of inputs: %s", n_inputs)
 
-        inputs = self._arcom.read_char_array(array_len=n_inputs)  # type: list(str)
+        # The number of outputs is sent right after the inputs, so read both in one go.
+        data = self._bpodcom_read_exactly(n_inputs + 1)
+
+        inputs = list(data[:n_inputs].decode("utf-8"))  # type: list(str)
         logger.debug("Read inputs: %s", inputs)
 
-        n_outputs = self._arcom.read_uint8()  # type: int
+        n_outputs = data[n_inputs]  # type: int
         logger.debug("Read number of outputs: %s", n_outputs)
 
-        outputs = self._arcom.read_char_array(array_len=n_outputs)  # type: list(str)
+        data = self._bpodcom_read_exactly(n_outputs)
+
+        outputs = list(data.decode("utf-8"))  # type: list(str)
         logger.debug("Read outputs: %s", outputs)
 
         hardware.max_states = max_states
@@ -308,10 +446,16 @@ class BpodCOMProtocol(BpodBase):
         hardware.inputs = inputs
         hardware.outputs = outputs  # + ['G', 'G', 'G']
 
-        hardware.n_uart_channels = len([idx for idx in inputs if idx == "U"])
-        hardware.n_flex_channels = len([idx for idx in inputs if idx == "F"])
+        input_types_count = Counter(inputs)
+        hardware.n_uart_channels = input_types_count["U"]
+        hardware.n_flex_channels = input_types_count["F"]
 
-        hardware.live_timestamps = self._bpodcom_get_timestamp_transmission()
+        self._times_scale = float(hardware.times_scale_factor)
+        self._freq_div = float(hardware.DEFAULT_FREQUENCY_DIVIDER)
+        self._cycle_freq = float(hardware.cycle_frequency)
+
+        logger.debug("Get timestamp transmission")
+        hardware.live_timestamps = self._arcom.read_byte()
 
     def _bpodcom_enable_ports(self, hardware):
         """
@@ -322,33 +466,26 @@ class BpodCOMProtocol(BpodBase):
         """
 
         ###### set inputs enabled or disabled #######################################################
-        hardware.inputs_enabled = [0] * len(hardware.inputs)
-
-        for j, i in enumerate(hardware.bnc_inputports_indexes):
-            hardware.inputs_enabled[i] = settings.BPOD_BNC_PORTS_ENABLED[j]
-
-        for j, i in enumerate(hardware.wired_inputports_indexes):
-            hardware.inputs_enabled[i] = settings.BPOD_WIRED_PORTS_ENABLED[j]
-
-        for j, i in enumerate(hardware.behavior_inputports_indexes):
-            hardware.inputs_enabled[i] = settings.BPOD_BEHAVIOR_PORTS_ENABLED[j]
-        
-        for j, i in enumerate(hardware.flex_inputports_indexes):
-            hardware.inputs_enabled[i] = settings.BPOD_FLEX_PORTS_ENABLED[j]
+        # The packet is built in place: the op code followed by one enable flag per input.
+        bytes2send = bytearray(1 + len(hardware.inputs))
+        bytes2send[0] = _OP_ENABLE_PORTS
+
+        for indexes, enabled in (
+            (hardware.bnc_inputports_indexes, settings.BPOD_BNC_PORTS_ENABLED),
+            (hardware.wired_inputports_indexes, settings.BPOD_WIRED_PORTS_ENABLED),
+            (hardware.behavior_inputports_indexes, settings.BPOD_BEHAVIOR_PORTS_ENABLED),
+            (hardware.flex_inputports_indexes, settings.BPOD_FLEX_PORTS_ENABLED),
+        ):
+            for j, i in enumerate(indexes):
+                bytes2send[1 + i] = enabled[j]
+
+        hardware.inputs_enabled = list(bytes2send[1:])
         #############################################################################################
 
         logger.debug("Requesting ports enabling ('%s')", SendMessageHeader.ENABLE_PORTS)
         logger.debug("Inputs enabled (%s): %s", len(hardware.inputs_enabled), hardware.inputs_enabled)
 
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.ENABLE_PORTS)] + hardware.inputs_enabled)
-
-        self._arcom.write_array(bytes2send)
-
-        response = self._arcom.read_uint8()  # type: int
-
-        logger.debug("Response: %s", response)
-
-        return response == ReceiveMessageHeader.ENABLE_PORTS_OK
+        return self._bpodcom_write_and_confirm(bytes2send, ReceiveMessageHeader.ENABLE_PORTS_OK)
     
     def _bpodcom_set_sync_channel_and_mode(self, sync_channel, sync_mode):
         """
@@ -361,25 +498,16 @@ class BpodCOMProtocol(BpodBase):
 
         logger.debug("Requesting sync channel and mode ('%s')", SendMessageHeader.SYNC_CHANNEL_MODE)
 
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.SYNC_CHANNEL_MODE), sync_channel, sync_mode])
+        bytes2send = _PACK_3B(_OP_SYNC_CHANNEL_MODE, sync_channel, sync_mode)
 
-        self._arcom.write_array(bytes2send)
-
-        response = self._arcom.read_uint8()  # type: int
-
-        logger.debug("Response: %s", response)
-
-        return response == ReceiveMessageHeader.SYNC_CHANNEL_MODE_OK
+        return self._bpodcom_write_and_confirm(bytes2send, ReceiveMessageHeader.SYNC_CHANNEL_MODE_OK)
 
     def _bpodcom_echo_softcode(self, softcode):
         """
         Send soft code
         """
         logger.debug("Echo softcode")
-        self._arcom.write_char(SendMessageHeader.ECHO_SOFTCODE)
-        self._arcom.write_char(softcode)
-
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.ECHO_SOFTCODE), softcode])
+        bytes2send = _PACK_2B(_OP_ECHO_SOFTCODE, softcode)
         self._arcom.write_array(bytes2send)
 
     def _bpodcom_manual_override_exec_event(self, event_index, event_data):
@@ -387,7 +515,7 @@ class BpodCOMProtocol(BpodBase):
         Send soft code
         """
         logger.debug("Manual override execute virtual event")
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.MANUAL_OVERRIDE_EXEC_EVENT), event_index, event_data])
+        bytes2send = _PACK_3B(_OP_MANUAL_OVERRIDE_EXEC_EVENT, event_index, event_data)
         self._arcom.write_array(bytes2send)
 
     def _bpodcom_override_input_state(self, channel_number, value):
@@ -399,8 +527,7 @@ class BpodCOMProtocol(BpodBase):
         """
         logger.debug("Override input state")
 
-        bytes2send = ArduinoTypes.get_uint8_array(
-            [ord(SendMessageHeader.MANUAL_OVERRIDE_EXEC_EVENT), channel_number, value])
+        bytes2send = _PACK_3B(_OP_MANUAL_OVERRIDE_EXEC_EVENT, channel_number, value)
         self._arcom.write_array(bytes2send)
 
     def _bpodcom_send_softcode(self, softcode):
@@ -408,7 +535,7 @@ class BpodCOMProtocol(BpodBase):
         Send soft code
         """
         logger.debug("Send softcode")
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.TRIGGER_SOFTCODE), softcode])
+        bytes2send = _PACK_2B(_OP_TRIGGER_SOFTCODE, softcode)
         self._arcom.write_array(bytes2send)
 
     def _bpodcom_send_state_machine(self, message):
@@ -433,9 +560,25 @@ class BpodCOMProtocol(BpodBase):
         self._arcom.write_char(SendMessageHeader.RUN_STATE_MACHINE)
 
     def _bpodcom_get_trial_timestamp_start(self):
-        data = self._arcom.read_bytes_array(8)
-        self.trial_start_micros = ArduinoTypes.cvt_uint64(b''.join(data))
-        return self.trial_start_micros / float(self.hardware.DEFAULT_FREQUENCY_DIVIDER)
+        self.trial_start_micros = _UNPACK_UINT64(self._bpodcom_read_exactly(8))[0]
+        return self.trial_start_micros / self._freq_div
+
+    def _bpodcom_read_exactly(self, size):
+        """
+        Read exactly size bytes from the primary serial port.
+
+        :param int size: number of bytes to read
+        :rtype: bytes
+        :raises BpodErrorException: if Bpod does not send the expected number of bytes in time
+        """
+        data = self._arcom.read_exactly(size)
+
+        if len(data) < size:
+            raise BpodErrorException(
+                "Error: Expected {0} bytes from Bpod but only {1} were received. Please reset Bpod and try again.".format(
+                    size, len(data)))
+
+        return data
 
     def _bpodcom_read_trial_start_timestamp_seconds(self):
         """
@@ -451,17 +594,14 @@ class BpodCOMProtocol(BpodBase):
 
         # trial_start_timestamp = response / 1000.0
 
-        return response * self.hardware.times_scale_factor
+        return response * self._times_scale
 
     def _bpodcom_read_timestamps(self):
 
-        data = self._arcom.read_bytes_array(12)
-
-        n_hw_timer_cyles = ArduinoTypes.cvt_uint32(b''.join(data[:4]))
-        trial_end_micros = ArduinoTypes.cvt_uint64(b''.join(data[4:12]))  # / float(self.hardware.DEFAULT_FREQUENCY_DIVIDER)
-        trial_end_timestamp = trial_end_micros / float(self.hardware.DEFAULT_FREQUENCY_DIVIDER)
+        n_hw_timer_cyles, trial_end_micros = _UNPACK_TRIAL_END_TIMESTAMPS(self._bpodcom_read_exactly(12))
+        trial_end_timestamp = trial_end_micros / self._freq_div
         trial_time_from_micros = trial_end_timestamp - self.trial_start_timestamp
-        trial_time_from_cycles = n_hw_timer_cyles/self.hardware.cycle_frequency
+        trial_time_from_cycles = n_hw_timer_cyles / self._cycle_freq
         discrepancy = abs(trial_time_from_micros - trial_time_from_cycles)*1000
 
         return trial_end_timestamp, discrepancy
@@ -474,6 +614,7 @@ class BpodCOMProtocol(BpodBase):
         """
         # self.__bpodcom_check_com_ready()
 
+        self._bpodcom_check_no_pending_replies()
         response = self._arcom.read_uint8()  # type: int
 
         logger.debug("Read state machine installation status: %s", response)
@@ -508,12 +649,13 @@ class BpodCOMProtocol(BpodBase):
         A new incoming timestamps message is available.
         Read number of timestamps to be sent and then read timestamps array.
 
-        :return: timestamps array
-        :rtype: list(float)
+        :return: timestamps array, in seconds
+        :rtype: numpy.ndarray
         """
-        n_timestamps = self._arcom.read_uint16()  # type: int
+        n_timestamps = _UNPACK_UINT16(self._bpodcom_read_exactly(2))[0]  # type: int
 
-        timestamps = self._arcom.read_uint32_array(array_len=n_timestamps)
+        data = self._bpodcom_read_exactly(4 * n_timestamps)
+        timestamps = np.frombuffer(data, dtype="<u4") * self._times_scale
 
         logger.debug("Received timestamps: %s", timestamps)
 
@@ -528,7 +670,7 @@ class BpodCOMProtocol(BpodBase):
         :return: a list with events
         :rtype: list(int)
         """
-        current_events = self._arcom.read_uint8_array(array_len=n_events)
+        current_events = list(self._bpodcom_read_exactly(n_events))
 
         logger.debug("Received current events: %s", current_events)
 
@@ -536,21 +678,23 @@ class BpodCOMProtocol(BpodBase):
 
     def _bpodcom_read_event_timestamp(self):
         v = self._arcom.read_uint32()
-        return float(v) * self.hardware.times_scale_factor
+        return v * self._times_scale
 
     def _bpodcom_load_serial_message(self, serial_channel, message_id, serial_message, n_messages, max_bytes):
         """
         Load serial message on channel
 
-        :param TODO
+        :param serial_channel: serial channel number (1-based) or the BpodModule connected to it
+        :param int message_id: id of the message (1-255)
+        :param serial_message: message bytes, as bytes or a list of ints
+        :param int n_messages: number of messages being loaded
+        :param int max_bytes: maximum number of bytes allowed per serial message
         :rtype: bool
         """
         # self.__bpodcom_check_com_ready()
 
-        if isinstance(serial_channel, BpodModule):
-            serial_channel = serial_channel.serial_port
-
-        self.msg_id_list[message_id] = True
+        # serial_channel is either a channel number or a BpodModule; the firmware expects a 0-based channel index.
+        channel_index = getattr(serial_channel, "serial_port", serial_channel) - 1
 
         if len(serial_message) > max_bytes:
             raise BpodErrorException("Error: Serial messages cannot be more than {0} bytes in length.".format(max_bytes))
@@ -558,20 +702,19 @@ class BpodCOMProtocol(BpodBase):
         if not (1 <= message_id <= 255):
             raise BpodErrorException('Error: Bpod can only store 255 serial messages (indexed 1-255). You used the message_id {0}'.format(message_id))
 
-        message_container = [serial_channel-1, n_messages, message_id, len(serial_message)] + serial_message
-
-        logger.debug("Requesting load serial message ('%s')", SendMessageHeader.LOAD_SERIAL_MESSAGE)
-        logger.debug("Message: %s", message_container)
-
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.LOAD_SERIAL_MESSAGE)] + message_container)
+        self.msg_id_bitmap[message_id >> 3] |= 1 << (message_id & 7)
 
-        self._arcom.write_array(bytes2send)
-
-        response = self._arcom.read_uint8()  # type: int
+        serial_message = bytes(serial_message)
+        n_bytes = len(serial_message)
+        bytes2send = struct.pack(
+            "<5B{0}s".format(n_bytes),
+            _OP_LOAD_SERIAL_MESSAGE, channel_index, n_messages, message_id, n_bytes, serial_message)
 
-        logger.debug("Confirmation: %s", response)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Requesting load serial message ('%s')", SendMessageHeader.LOAD_SERIAL_MESSAGE)
+            logger.debug("Message: %s", list(bytes2send[1:]))
 
-        return response == ReceiveMessageHeader.LOAD_SERIAL_MESSAGE_OK
+        return self._bpodcom_write_and_confirm(bytes2send, ReceiveMessageHeader.LOAD_SERIAL_MESSAGE_OK)
 
     def _bpodcom_reset_serial_messages(self):
         """
@@ -581,6 +724,7 @@ class BpodCOMProtocol(BpodBase):
         """
         logger.debug("Requesting serial messages reset ('%s')", SendMessageHeader.RESET_SERIAL_MESSAGES)
 
+        self._bpodcom_check_no_pending_replies()
         self._arcom.write_char(SendMessageHeader.RESET_SERIAL_MESSAGES)
 
         response = self._arcom.read_uint8()  # type: int
@@ -597,8 +741,7 @@ class BpodCOMProtocol(BpodBase):
         :param int value: value to be written
         """
 
-        bytes2send = ArduinoTypes.get_uint8_array(
-            [ord(SendMessageHeader.OVERRIDE_DIGITAL_HW_STATE), channel_number, value])
+        bytes2send = _PACK_3B(_OP_OVERRIDE_DIGITAL_HW_STATE, channel_number, value)
         self._arcom.write_array(bytes2send)
 
     def _bpodcom_send_byte_to_hardware_serial(self, channel_number, value):
@@ -608,9 +751,7 @@ class BpodCOMProtocol(BpodBase):
         :param int channel_number:
         :param int value: value to be written
         """
-        bytes2send = ArduinoTypes.get_uint8_array(
-            [ord(SendMessageHeader.SEND_TO_HW_SERIAL), channel_number, value]
-        )
+        bytes2send = _PACK_3B(_OP_SEND_TO_HW_SERIAL, channel_number, value)
         self._arcom.write_array(bytes2send)
 
     def _bpodcom_set_flex_channel_types(self, channel_types):
@@ -622,13 +763,8 @@ class BpodCOMProtocol(BpodBase):
         """
 
         logger.debug("Setting Flex channel types ('%s')", SendMessageHeader.SET_FLEX_CHANNEL_TYPES)
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.SET_FLEX_CHANNEL_TYPES)] + channel_types)
-        self._arcom.write_array(bytes2send)
-
-        response = self._arcom.read_uint8()
-        logger.debug("Response: %s", response)
-
-        return (response == ReceiveMessageHeader.SET_FLEX_CHANNEL_TYPES_OK)
+        bytes2send = bytes([_OP_SET_FLEX_CHANNEL_TYPES] + list(channel_types))
+        return self._bpodcom_write_and_confirm(bytes2send, ReceiveMessageHeader.SET_FLEX_CHANNEL_TYPES_OK)
 
     def _bpodcom_get_flex_channel_types(self, n_flex_channels):
         """
@@ -637,6 +773,7 @@ class BpodCOMProtocol(BpodBase):
         """
 
         logger.debug("Requesting current flex channel types ('%s')", SendMessageHeader.GET_FLEX_CHANNEL_TYPES)
+        self._bpodcom_check_no_pending_replies()
         self._arcom.write_char(SendMessageHeader.GET_FLEX_CHANNEL_TYPES)
         
         flex_channel_types = self._arcom.read_uint8_array(n_flex_channels)
@@ -655,16 +792,10 @@ class BpodCOMProtocol(BpodBase):
         :param int sampling_interval: Interval at which to sample analog input flex channels. Units are state machine clock cycles.
         :rtype bool
         """
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.SET_ANALOG_INPUT_SAMPLING_INTERVAL)])
-        bytes2send += ArduinoTypes.get_uint32_array([sampling_interval])
+        bytes2send = _PACK_SAMPLING_INTERVAL(_OP_SET_ANALOG_INPUT_SAMPLING_INTERVAL, sampling_interval)
 
         logger.debug("Setting analog input sampling interval ('%s')", SendMessageHeader.SET_ANALOG_INPUT_SAMPLING_INTERVAL)
-        self._arcom.write_array(bytes2send)
-
-        response = self._arcom.read_uint8()  # type: int
-        logger.debug("Response: %s", response)
-
-        return (response == ReceiveMessageHeader.SET_ANALOG_INPUT_SAMPLING_INTERVAL_OK)
+        return self._bpodcom_write_and_confirm(bytes2send, ReceiveMessageHeader.SET_ANALOG_INPUT_SAMPLING_INTERVAL_OK)
     
     def _bpodcom_set_analog_input_thresholds(self, thresholds_1, thresholds_2):
         """
@@ -675,16 +806,11 @@ class BpodCOMProtocol(BpodBase):
         :param list[int] thresholds_2: List of the second threshold values for each channel. Units are bits ranging from 0 to 4095.
         :rtype bool
         """
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.SET_ANALOG_INPUT_THRESHOLDS)])
-        bytes2send += ArduinoTypes.get_uint16_array(thresholds_1 + thresholds_2)
+        thresholds = thresholds_1 + thresholds_2
+        bytes2send = struct.pack("<B{0}H".format(len(thresholds)), _OP_SET_ANALOG_INPUT_THRESHOLDS, *thresholds)
         
         logger.debug("Setting analog input thresholds ('%s')", SendMessageHeader.SET_ANALOG_INPUT_THRESHOLDS)
-        self._arcom.write_array(bytes2send)
-
-        response = self._arcom.read_uint8()  # type: int
-        logger.debug("Response: %s", response)
-
-        return (response == ReceiveMessageHeader.SET_ANALOG_INPUT_THRESHOLDS_OK)
+        return self._bpodcom_write_and_confirm(bytes2send, ReceiveMessageHeader.SET_ANALOG_INPUT_THRESHOLDS_OK)
 
     def _bpodcom_set_analog_input_threshold_polarity(self, polarity_1, polarity_2):
         """
@@ -696,15 +822,10 @@ class BpodCOMProtocol(BpodBase):
         :param list[int] polarity_2: List of polarities of the second threshold for each channel. Value is 0 or 1.
         :rtype bool
         """
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.SET_ANALOG_INPUT_THRESHOLD_POLARITY)] + polarity_1 + polarity_2)
+        bytes2send = bytes([_OP_SET_ANALOG_INPUT_THRESHOLD_POLARITY] + list(polarity_1) + list(polarity_2))
         
         logger.debug("Setting analog input threshold polarity ('%s')", SendMessageHeader.SET_ANALOG_INPUT_THRESHOLD_POLARITY)
-        self._arcom.write_array(bytes2send)
-
-        response = self._arcom.read_uint8()  # type: int
-        logger.debug("Response: %s", response)
-
-        return (response == ReceiveMessageHeader.SET_ANALOG_INPUT_THRESHOLD_POLARITY_OK)
+        return self._bpodcom_write_and_confirm(bytes2send, ReceiveMessageHeader.SET_ANALOG_INPUT_THRESHOLD_POLARITY_OK)
 
     def _bpodcom_set_analog_input_threshold_mode(self, modes):
         """
@@ -715,15 +836,10 @@ class BpodCOMProtocol(BpodBase):
         :param list[int] modes: List of modes for each channel. Value is 0 or 1.
         :rtype bool
         """
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.SET_ANALOG_INPUT_THRESHOLD_MODE)] + modes)
+        bytes2send = bytes([_OP_SET_ANALOG_INPUT_THRESHOLD_MODE] + list(modes))
         
         logger.debug("Setting analog input threshold mode ('%s')", SendMessageHeader.SET_ANALOG_INPUT_THRESHOLD_MODE)
-        self._arcom.write_array(bytes2send)
-
-        response = self._arcom.read_uint8()  # type: int
-        logger.debug("Response: %s", response)
-
-        return (response == ReceiveMessageHeader.SET_ANALOG_INPUT_THRESHOLD_MODE_OK)
+        return self._bpodcom_write_and_confirm(bytes2send, ReceiveMessageHeader.SET_ANALOG_INPUT_THRESHOLD_MODE_OK)
 
     def _bpodcom_enable_analog_input_threshold(self, channel, threshold, value):
         """
@@ -734,17 +850,67 @@ class BpodCOMProtocol(BpodBase):
         :param int value: Disabled = 0, Enabled = 1.
         :rtype bool
         """
-        bytes2send = ArduinoTypes.get_uint8_array([ord(SendMessageHeader.ENABLE_ANALOG_INPUT_THRESHOLD), channel, threshold, value])
+        self._bpodcom_check_no_pending_replies()
+        self._bpodcom_enable_analog_input_threshold_nowait(channel, threshold, value)
+        return self._bpodcom_flush_replies()[0]
+
+    def _bpodcom_enable_analog_input_threshold_nowait(self, channel, threshold, value):
+        """
+        Same as :meth:`_bpodcom_enable_analog_input_threshold`, but returns as soon as the command is sent.
+        Several commands can be sent back to back this way, so that their round trips overlap. The confirmations must then
+        be collected with :meth:`_bpodcom_flush_replies` before sending any other command (which raises otherwise).
+
+        :param int channel: Index of flex channel (0 - 3).
+        :param int threshold: Index of threshold (0 or 1).
+        :param int value: Disabled = 0, Enabled = 1.
+        """
+        bytes2send = _PACK_4B(_OP_ENABLE_ANALOG_INPUT_THRESHOLD, channel, threshold, value)
 
         logger.debug("Enabling analog input threshold ('%s')", SendMessageHeader.ENABLE_ANALOG_INPUT_THRESHOLD)
         self._arcom.write_array(bytes2send)
+        self._pending_replies.append(ReceiveMessageHeader.ENABLE_ANALOG_INPUT_THRESHOLD_OK)
 
-        response = self._arcom.read_uint8()  # type: int
-        logger.debug("Response: %s", response)
+    def _bpodcom_flush_replies(self):
+        """
+        Read the confirmations of all the commands sent without waiting for their reply, with a single read.
+
+        :return: for each pending command, in the order they were sent, True if it was confirmed, False otherwise
+        :rtype: list[bool]
+        """
+        expected = self._pending_replies
+        self._pending_replies = deque()
+        if not expected:
+            return []
+
+        # Replies that never arrived (short read) count as failures.
+        replies = self._arcom.read_exactly(len(expected))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Responses: %s", list(replies))
 
-        return (response == ReceiveMessageHeader.ENABLE_ANALOG_INPUT_THRESHOLD_OK)
+        return [i < len(replies) and replies[i] == ok_response for i, ok_response in enumerate(expected)]
+
+    def _bpodcom_discard_replies(self):
+        """
+        Forget the confirmations expected for the commands sent without waiting for their reply, when they will not be
+        collected with :meth:`_bpodcom_flush_replies` (e.g. after a serial error while sending them).
+        """
+        self._pending_replies.clear()
+
+    def _bpodcom_check_no_pending_replies(self):
+        """
+        Make sure that no confirmation is still expected from a command sent without waiting for its reply, since it
+        would otherwise be read as the reply of the next command. Called by every command that reads a reply on the
+        primary port (or, for the handshakes, is sent on it), except the trial event readers, which are only used while
+        a trial runs.
+
+        :raises BpodErrorException: if :meth:`_bpodcom_flush_replies` was not called after such commands
+        """
+        if self._pending_replies:
+            raise BpodErrorException("Error: {0} command replies were not collected before sending another command.".format(
+                len(self._pending_replies)))
     
-    def _bpodcom_read_analog_input_samples(self, n_channels):
+    def _bpodcom_read_analog_input_samples(self, n_channels, timeout=0):
         """
         While running a trial, any channels configured as analog inputs return samples to the PC via the analog serial port.
         The data format on that port is: [TrialNumber, uint16] [Sample Ch0, uint16]...[Sample ChN, uint16].
@@ -754,17 +920,236 @@ class BpodCOMProtocol(BpodBase):
         TrialNumber is reset at the beginning of each behavior session with op '*' on the state machine's primary port.
 
         :param int n_channels: number of flex channels configured as analog input.
-        :return: List of samples for each analog input channel in uint16, including trial number with each sample.
-        :rtype list[int]:
-        """
-        n_bytes_available = self._arcom_analog.bytes_available()
-        if n_bytes_available > 0:
-            n_samples = int(n_bytes_available / (2 * (n_channels + 1)))  # Add 1 to n_channels to account for the trial number, which must be read before the sample(s). Each sample and trial number is uint16 which is 2 bytes.
-            if n_samples > 0:
-                msg = self._arcom_analog.read_uint16_array((n_samples * (n_channels + 1)))
-                return msg
-        return []  # return an empty list if nothing to be read.
+        :param float timeout: seconds to wait for at least one sample when none was received yet (0 returns immediately,
+            None waits indefinitely).
+        :return: trial numbers, of shape (n_samples,), and samples, of shape (n_samples, n_channels), as uint16 arrays.
+            Both are views over the received bytes, so no data is copied; e.g. frame.samples[:, k] holds channel k.
+        :rtype SamplesFrame:
+        """
+        frame_size = 2 * (n_channels + 1)  # Add 1 to n_channels to account for the trial number, which must be read before the sample(s). Each sample and trial number is uint16 which is 2 bytes.
+
+        # The bytes are received by the background reader (see _bpodcom_start_analog_reader). Take the whole buffer and
+        # give the reader a new one holding only the trailing partial frame, if any, to preserve alignment on the next call.
+        with self._analog_buffer_condition:
+            if timeout != 0:
+                # Also give up once the reader is stopped or gone, since no more bytes will arrive (an empty frame is returned).
+                self._analog_buffer_condition.wait_for(
+                    lambda: len(self._analog_buffer) >= frame_size or not self.__analog_reader_running(), timeout)
+            data = self._analog_buffer
+            n_bytes_aligned = (len(data) // frame_size) * frame_size
+            self._analog_buffer = data[n_bytes_aligned:]
+
+        frames = np.frombuffer(data, dtype="<u2", count=n_bytes_aligned // 2).reshape(-1, n_channels + 1)
+        return SamplesFrame(trial=frames[:, 0], samples=frames[:, 1:])
+
+    def _bpodcom_start_analog_reader(self):
+        """
+        Start the background thread that continuously drains the analog serial port into a buffer.
+        Only compatible with Bpod r2+ (machine_type == 4).
+
+        Samples keep arriving while the user code is busy elsewhere, so draining the port in its own thread prevents the
+        USB buffers from overflowing between calls to :meth:`_bpodcom_read_analog_input_samples`. pyserial releases the GIL
+        while waiting for data, so the reader does not stall the main thread.
+        """
+        if self._analog_reader is not None:
+            return
+
+        self._arcom_analog.serial_object.timeout = ANALOG_READER_TIMEOUT
+        self._analog_reader_stop.clear()
+        with self._analog_buffer_condition:
+            # drop the bytes left over from a previous session, which would otherwise be returned as new samples
+            self._analog_buffer = bytearray()
+            self._analog_buffer_overflowed = False
+        self._analog_reader = threading.Thread(target=self.__analog_reader_loop, name="BpodAnalogReader", daemon=True)
+        self._analog_reader.start()
+
+    def _bpodcom_stop_analog_reader(self):
+        """
+        Stop the background thread started by :meth:`_bpodcom_start_analog_reader`, if it is running.
+        """
+        if self._analog_reader is None:
+            return
+
+        self._analog_reader_stop.set()
+        self._analog_reader.join()
+        self._analog_reader = None
+
+        with self._analog_buffer_condition:
+            self._analog_buffer_condition.notify_all()  # wake up the callers waiting for samples
+
+    def __analog_reader_running(self):
+        reader = self._analog_reader
+        return reader is not None and reader.is_alive() and not self._analog_reader_stop.is_set()
+
+    def __analog_reader_loop(self):
+        serial_object = self._arcom_analog.serial_object
+
+        while not self._analog_reader_stop.is_set():
+            try:
+                # Read everything already buffered, or block until at least one byte arrives or the timeout expires.
+                data = serial_object.read(serial_object.in_waiting or 1)
+            except SerialException as err:
+                logger.error("Stopped reading the analog serial port: %s", err)
+                with self._analog_buffer_condition:
+                    self._analog_reader_stop.set()  # so that the callers waiting for samples see that the reader is gone
+                    self._analog_buffer_condition.notify_all()
+                return
+
+            if data:
+                with self._analog_buffer_condition:
+                    self._analog_buffer += data
+                    if len(self._analog_buffer) > ANALOG_BUFFER_MAX_SIZE:
+                        self.__drop_oldest_analog_frames()
+                    self._analog_buffer_condition.notify_all()
+
+    def __drop_oldest_analog_frames(self):
+        # The buffer always starts on a frame boundary, so dropping a whole number of frames keeps it aligned.
+        frame_size = 2 * (len(self._hardware.analog_input_channels or ()) + 1)
+        n_frames = -(-(len(self._analog_buffer) - ANALOG_BUFFER_MAX_SIZE) // frame_size)  # round up
+        del self._analog_buffer[:n_frames * frame_size]
+
+        if not self._analog_buffer_overflowed:
+            self._analog_buffer_overflowed = True
+            logger.warning("Analog input samples are not read fast enough, dropping the oldest samples "
+                           "(more than %s bytes were buffered)", ANALOG_BUFFER_MAX_SIZE)
     
+    def _bpodcom_probe_primary_port(self, port):
+        """
+        Test if a serial port is the Bpod r2+ (machine_type == 4) primary port.
+        The connection is left open so that it can be reused to test for the secondary and analog serial ports.
+
+        :param str port: serial port to test
+        :return: connection to the port, True if the port sent the primary port ping, False otherwise
+        :rtype: ArCOM, bool
+        :raises SerialException: if the port cannot be opened or read
+        """
+        logger.debug("Testing primary port using: %s", port)
+        test_connect = ArCOM().fast_open(serial_port=port, baudrate=self.baudrate, timeout=1)
+        try:
+            reading = test_connect.read_uint8()
+        except SerialException:
+            test_connect.close()
+            raise
+
+        # Bpod writes 0xDE every 100ms on its primary COM port. 0xDE in decimal is 222 which refers to firmware version 22.
+        return test_connect, reading == ReceiveMessageHeader.PRIMARY_PORT_PING
+
+    def _bpodcom_read_port_cache(self):
+        """
+        Read the Bpod r2+ serial ports cached by previous runs.
+
+        :return: Map of primary port identifier to the cached (primary, secondary, analog) ports
+        :rtype: dict(str, list(str))
+        """
+        cache_file = getattr(settings, "PYBPOD_PORT_CACHE_FILE", None)
+        if not cache_file:
+            return {}
+
+        cache_file = os.path.expanduser(cache_file)
+        if not os.path.isfile(cache_file):
+            return {}
+
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as err:
+            logger.debug("Could not read the serial ports cache %s: %s", cache_file, err)
+            return {}
+
+        # The cache is only an optimisation, so ignore a file that does not have the expected shape.
+        if not isinstance(cache, dict) or not all(
+            isinstance(ports, list) and len(ports) == 3 for ports in cache.values()
+        ):
+            logger.debug("Ignoring malformed serial ports cache %s", cache_file)
+            return {}
+
+        return cache
+
+    def _bpodcom_write_port_cache(self, cache):
+        """
+        Save the Bpod r2+ serial ports cache.
+
+        :param dict(str, list(str)) cache: map of primary port identifier to the (primary, secondary, analog) ports
+        """
+        cache_file = getattr(settings, "PYBPOD_PORT_CACHE_FILE", None)
+        if not cache_file:
+            return
+
+        cache_file = os.path.expanduser(cache_file)
+        try:
+            cache_dir = os.path.dirname(cache_file)
+            if cache_dir:
+                os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file, "w") as f:
+                json.dump(cache, f)
+        except OSError as err:
+            logger.debug("Could not write the serial ports cache %s: %s", cache_file, err)
+
+    def _bpodcom_verify_ports(self, primary_port, secondary_port, analog_port):
+        """
+        Check that previously identified ports still are the Bpod r2+ primary, secondary and analog serial ports.
+
+        :rtype: bool
+        """
+        connections = []
+        try:
+            primary_connection = ArCOM().fast_open(serial_port=primary_port, baudrate=self.baudrate, timeout=1)
+            connections.append(primary_connection)
+            if primary_connection.read_uint8() != ReceiveMessageHeader.PRIMARY_PORT_PING:
+                return False
+
+            if secondary_port:
+                test_connect = ArCOM().fast_open(serial_port=secondary_port, baudrate=self.baudrate, timeout=1)
+                connections.append(test_connect)
+                primary_connection.write_char(SendMessageHeader.SECONDARY_PORT_HANDSHAKE)
+                if test_connect.read_uint8() != ReceiveMessageHeader.SECONDARY_PORT_HANDSHAKE_OK:
+                    return False
+
+            if analog_port:
+                test_connect = ArCOM().fast_open(serial_port=analog_port, baudrate=self.baudrate, timeout=1)
+                connections.append(test_connect)
+                primary_connection.write_char(SendMessageHeader.ANALOG_PORT_HANDSHAKE)
+                if test_connect.read_uint8() != ReceiveMessageHeader.ANALOG_PORT_HANDSHAKE_OK:
+                    return False
+
+            return True
+
+        except SerialException:
+            return False
+
+        finally:
+            for connection in connections:
+                connection.close()
+
+    def _bpodcom_find_cached_ports(self, ports_ids):
+        """
+        Look for a Bpod r2+ whose serial ports were cached by a previous run, and check that they still respond.
+        Cache entries that fail the check are removed.
+
+        :param dict(str, str) ports_ids: map of the available serial ports to their USB identifier
+        :return: primary port, secondary port, analog port, or None if no cached ports are valid
+        :rtype: three-tuple
+        """
+        cache = self._bpodcom_read_port_cache()
+        if not cache:
+            return None
+
+        for port, port_id in ports_ids.items():
+            cached_ports = cache.get(port_id)
+            if not cached_ports or cached_ports[0] != port:
+                continue
+
+            logger.debug("Testing cached serial ports: %s", cached_ports)
+            if self._bpodcom_verify_ports(*cached_ports):
+                return tuple(cached_ports)
+
+            logger.debug("Cached serial ports are no longer valid: %s", cached_ports)
+            del cache[port_id]
+            self._bpodcom_write_port_cache(cache)
+            break
+
+        return None
+
     def _bpodcom_identify_USB_serial_ports(self):
         """
         Identify the Bpod r2+ (machine_type == 4) primary, secondary, and analog serial ports.
@@ -778,71 +1163,144 @@ class BpodCOMProtocol(BpodBase):
         :rtype: three-tuple
         :return: primary port, secondary port, analog port
         """
-        available_ports = ArCOM.list_ports()
+        # Enumerating the serial ports is slow (especially on Windows), so do it only once.
+        comports = serial.tools.list_ports.comports()
+        available_ports = ArCOM.list_ports(usb_ids=BPOD_USB_IDS, comports=comports)
+        if not available_ports:
+            logger.debug("No serial port with a known Bpod USB id, testing all the serial ports")
+            available_ports = ArCOM.list_ports(comports=comports)
         logger.debug("Available USB serial ports: %s", available_ports)
 
+        ports_ids = ArCOM.list_usb_ports_ids(comports=comports)
+
+        if not self.serial_port:
+            # The ports of a given Bpod rarely change on a machine, so try the ones found on a previous run first.
+            cached_ports = self._bpodcom_find_cached_ports(ports_ids)
+            if cached_ports:
+                logger.debug("Using cached serial ports: %s", cached_ports)
+                return cached_ports
+
         primary_port = None
         secondary_port = None
         analog_port = None
-        bad_ports = []
+        bad_ports = set()
+        connections = {}  # type: dict(str, ArCOM)
         
-        if not self.serial_port:
-            # This means that no serial port was given during Bpod object init, nor in the settings file. So try to find it.
-            for port in available_ports:
-                try:
-                    logger.debug("Testing primary port using: %s", port)
-                    test_connect = ArCOM().open(serial_port=port, baudrate=self.baudrate, timeout=1)
-                    reading = test_connect.read_uint8()
-                    if (reading == ReceiveMessageHeader.PRIMARY_PORT_PING):  # Bpod writes 0xDE every 100ms on its primary COM port. 0xDE in decimal is 222 which refers to firmware version 22.
+        primary_connection = None  # type: ArCOM
+        test_connections = {}  # type: dict(str, ArCOM)
+        try:
+            if not self.serial_port:
+                # This means that no serial port was given during Bpod object init, nor in the settings file. So try to find it.
+                # Each test may wait for the full read timeout, so test all the ports concurrently. Leaving the executor
+                # waits for every test to finish. The connections are kept to test for the secondary and analog ports later.
+                pinging_ports = set()
+                with ThreadPoolExecutor(max_workers=max(1, len(available_ports))) as executor:
+                    futures = {executor.submit(self._bpodcom_probe_primary_port, port): port for port in available_ports}
+                    for future in as_completed(futures):
+                        port = futures[future]
+                        try:
+                            test_connect, is_primary = future.result()
+                        except SerialException:
+                            logger.debug("Bad port: %s", port)
+                            bad_ports.add(port)
+                            continue
+
+                        if is_primary:
+                            pinging_ports.add(port)
+                        else:
+                            logger.debug("Nothing received from port: %s", port)
+                        connections[port] = test_connect
+
+                # Choose the primary port in the order of the available ports rather than in the order the tests finished,
+                # so that the same Bpod is chosen on every run when several are connected.
+                for port in available_ports:
+                    if port not in pinging_ports:
+                        continue
+                    if primary_port is None:
                         logger.debug("Primary port is: %s", port)
                         primary_port = port
-                        test_connect.close()
-                        break
                     else:
-                        logger.debug("Nothing received from port: %s", port)
-                        test_connect.close()
+                        # The primary port of another Bpod would answer the secondary port handshake with its ping.
+                        logger.debug("Ignoring the primary port of another Bpod: %s", port)
+                        connections.pop(port).close()
+                        bad_ports.add(port)
+            else:
+                primary_port = self.serial_port  # This means that a serial port was given either during Bpod object init or in the settings file. So use it.
+
+            if primary_port:  # Check if it was found from the previous for loop.
+                primary_connection = connections.pop(primary_port, None)
+                if primary_connection is None:
+                    primary_connection = ArCOM().fast_open(serial_port=primary_port, baudrate=self.baudrate, timeout=1)
+
+                # Leave out the primary port and the ports that could not be opened to avoid testing them again.
+                available_ports = [port for port in available_ports if port != primary_port and port not in bad_ports]
+
+                for port in available_ports:
+                    test_connect = connections.pop(port, None)
+                    try:
+                        if test_connect is None:
+                            logger.debug("Testing secondary and analog ports using: %s", port)
+                            test_connect = ArCOM().fast_open(serial_port=port, baudrate=self.baudrate, timeout=1)
+                        else:
+                            # Reuse the connection opened while looking for the primary port, dropping any byte received meanwhile.
+                            test_connect.serial_object.reset_input_buffer()
 
-                except SerialException:
-                    logger.debug("Bad port: %s", port)
-                    bad_ports.append(port)
-        else:
-            primary_port = self.serial_port  # This means that a serial port was given either during Bpod object init or in the settings file. So use it.
-        
-        if primary_port:  # Check if it was found from the previous for loop.
-            available_ports.remove(primary_port)  # remove from available ports to avoid testing it again.
-            for port in bad_ports:
-                available_ports.remove(port)
-            
-            primary_connection = ArCOM().open(serial_port=primary_port, baudrate=self.baudrate, timeout=1)
-            for port in available_ports:
-                try:
-                    if not secondary_port or not analog_port:
-                        logger.debug("Testing secondary and analog ports using: %s", port)
-                        test_connect = ArCOM().open(serial_port=port, baudrate=self.baudrate, timeout=1)
-                        primary_connection.write_char(SendMessageHeader.SECONDARY_PORT_HANDSHAKE)  # Send handshake byte for both the secondary serial port
-                        primary_connection.write_char(SendMessageHeader.ANALOG_PORT_HANDSHAKE)     # and the analog serial port.
-                        
-                        response = test_connect.read_uint8()  # The response will determine whether the current port is the secondary or analog serial port.
+                    except SerialException:
+                        logger.debug("Bad port: %s", port)
+                        bad_ports.add(port)
+                        if test_connect is not None:
+                            test_connect.close()
+                        continue
+
+                    test_connections[port] = test_connect
+
+                # Send the handshake bytes for both the secondary and the analog serial port in one write, then listen on all the
+                # candidate ports at the same time. The response will determine whether a port is the secondary or analog serial port.
+                primary_connection.write_array(_HANDSHAKE_PAIR)
+
+                pending_connections = dict(test_connections)
+                deadline = time.monotonic() + 1
+                while pending_connections and not (secondary_port and analog_port) and time.monotonic() < deadline:
+                    for port, test_connect in list(pending_connections.items()):
+                        try:
+                            if test_connect.bytes_available() == 0:
+                                continue
+                            response = test_connect.read_uint8()
+
+                        except SerialException:
+                            logger.debug("Bad port: %s", port)
+                            bad_ports.add(port)
+                            del pending_connections[port]
+                            continue
+
+                        del pending_connections[port]
                         if (response == ReceiveMessageHeader.SECONDARY_PORT_HANDSHAKE_OK):
                             logger.debug("Secondary port is: %s", port)
                             secondary_port = port
-                            test_connect.close()
                         elif (response == ReceiveMessageHeader.ANALOG_PORT_HANDSHAKE_OK):
                             logger.debug("Analog port is: %s", port)
                             analog_port = port
-                            test_connect.close()
                         else:
-                            logger.debug("Nothing received from port: %s", port)
-                            test_connect.close()
-                    else:
-                        break  # Break out of for loop once both the secondary and analog ports were found.
+                            logger.debug("Unexpected response from port %s: %s", port, response)
+                    time.sleep(0.001)
+
+                for port in pending_connections:
+                    logger.debug("Nothing received from port: %s", port)
+
+        finally:
+            # Close every connection opened for the tests, including the ones that were not reused
+            # (e.g. if no primary port was found) and when a test stopped on an error.
+            for test_connect in list(test_connections.values()) + list(connections.values()):
+                test_connect.close()
+
+            if primary_connection is not None:
+                primary_connection.close()
 
-                except SerialException:
-                    logger.debug("Bad port: %s", port)
-                    bad_ports.append(port)
+        if secondary_port and analog_port and primary_port in ports_ids:
+            cache = self._bpodcom_read_port_cache()
+            cache[ports_ids[primary_port]] = [primary_port, secondary_port, analog_port]
+            self._bpodcom_write_port_cache(cache)
 
-            primary_connection.close()
-            
         return primary_port, secondary_port, analog_port
     
     @property
@@ -134,6 +134,8 @@ class Channels(object):
         self.event_names = []
         self.input_channel_names = []
         self.output_channel_names = []
+        self.input_channel_indexes = {}  # type: dict(str, int)
+        self.output_channel_indexes = {}  # type: dict(str, int)
         self.events_positions = EventsPositions()
 
     def setup_input_channels(self, hardware, modules):
@@ -265,6 +267,8 @@ class Channels(object):
         self.events_positions.Tup = Pos
         Pos += 1
 
+        self.input_channel_indexes = self.__names_to_indexes(self.input_channel_names)
+
         logger.debug("event_names: %s", self.event_names)
         logger.debug("events_positions: %s", self.events_positions)
 
@@ -353,10 +357,25 @@ class Channels(object):
             self.events_positions.analogThreshEnable = len(self.output_channel_names) - 1
             self.output_channel_names += ["AnalogThreshDisable"]
             self.events_positions.analogThreshDisable = len(self.output_channel_names) - 1
-        
+
+        self.output_channel_indexes = self.__names_to_indexes(self.output_channel_names)
+
         logger.debug("output_channel_names: %s", self.output_channel_names)
         logger.debug("events_positions: %s", self.events_positions)
 
+    @staticmethod
+    def __names_to_indexes(names):
+        """
+        Map each channel name to its index, keeping the first occurrence (as list.index does)
+
+        :param list(str) names: channel names
+        :rtype: dict(str, int)
+        """
+        indexes = {}
+        for idx, name in enumerate(names):
+            indexes.setdefault(name, idx)
+        return indexes
+
     def get_event_name(self, event_idx):
         """
 
@@ -36,9 +36,10 @@ class BpodModule(object):
         :param int msg_id: Id of the message to use
         """
         if msg_id is None:
-            for i in range(255):
-                if not self.bpod_modules.bpod.msg_id_list[i]:
-                    msg_id = i + 1
+            msg_id_bitmap = self.bpod_modules.bpod.msg_id_bitmap
+            for i in range(1, 256):
+                if not (msg_id_bitmap[i >> 3] >> (i & 7)) & 1:
+                    msg_id = i
                     break
 
         self.bpod_modules.bpod.load_serial_message(self.serial_port, msg_id, msg)
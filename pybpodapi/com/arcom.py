@@ -2,13 +2,19 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
+import sys
 import serial
 import serial.tools.list_ports
 import numpy as np
 import struct
+import time
 
 logger = logging.getLogger(__name__)
 
+#: Maximum payload of a full-speed USB bulk packet, in bytes.
+USB_PACKET_SIZE = 64
+
 
 class DataType(object):
     def __init__(self, name, size):
@@ -88,14 +94,38 @@ class ArCOM(object):
     """
 
     @staticmethod
-    def list_ports():
+    def list_ports(usb_ids=None, comports=None):
         """
         Get a list of available serial ports.
 
+        :param set(tuple(int, int)) usb_ids: if given, only list the USB serial ports whose (VID, PID) pair is in this set.
+        :param list comports: result of serial.tools.list_ports.comports() to use instead of enumerating the ports again.
         :rtype: list[str]
         :return: List of available serial ports.
         """
-        return [comport.device for comport in serial.tools.list_ports.comports()]
+        if comports is None:
+            comports = serial.tools.list_ports.comports()
+        return [
+            comport.device for comport in comports
+            if usb_ids is None or (comport.vid, comport.pid) in usb_ids
+        ]
+
+    @staticmethod
+    def list_usb_ports_ids(comports=None):
+        """
+        Get a stable identifier for each available USB serial port.
+
+        :param list comports: result of serial.tools.list_ports.comports() to use instead of enumerating the ports again.
+        :rtype: dict(str, str)
+        :return: Map of serial port to its "VID:PID:SERIAL_NUMBER" identifier. Ports that are not USB devices are left out.
+        """
+        if comports is None:
+            comports = serial.tools.list_ports.comports()
+        return {
+            comport.device: "{0:04X}:{1:04X}:{2}".format(comport.vid, comport.pid, comport.serial_number)
+            for comport in comports
+            if comport.vid is not None
+        }
     
     def open(self, serial_port, baudrate=115200, timeout=1):
         """
@@ -110,6 +140,128 @@ class ArCOM(object):
 
         return self
 
+    def fast_open(self, serial_port, baudrate=115200, timeout=1):
+        """
+        Open serial connection with, on Windows, the DTR and RTS lines left low.
+
+        Some virtual COM port drivers stall for a long time on the modem control requests sent while the port is opened.
+        Configuring the lines before opening the port avoids them, which matters when many ports are probed in a row.
+        Devices that only transmit while DTR is asserted (e.g. the Arduino Due native port) will not send anything on
+        such a connection, so this is meant for the Bpod r2+ port identification; use :meth:`open` otherwise.
+
+        :param str serial_port: serial port to open
+        :param int baudrate: baudrate for serial connection
+        :param float timeout: timeout which controls the behavior of read()
+        :return: self
+        """
+        serial_object = serial.Serial(baudrate=baudrate, timeout=timeout)
+        serial_object.port = serial_port
+        if sys.platform == "win32":
+            serial_object.dtr = False
+            serial_object.rts = False
+        serial_object.open()
+
+        self.serial_object = serial_object
+        return self
+
+    def set_low_latency(self):
+        """
+        Lower the latency timer of FTDI USB serial adapters to 1 ms.
+
+        By default the FTDI driver holds incoming bytes for up to 16 ms before handing them to the host,
+        which delays every short reply and throttles streamed data. On Linux the timer is set through sysfs
+        and applies immediately. On Windows it is set in the FTDI driver registry key (which requires administrator
+        rights) and applies the next time the port is opened. Ports without a latency timer (e.g. USB CDC devices)
+        are left untouched.
+
+        :rtype: bool
+        :return: True if the latency timer was lowered, False otherwise.
+        """
+        if sys.platform.startswith("linux"):
+            return self._set_low_latency_linux()
+        elif sys.platform == "win32":
+            return self._set_low_latency_windows()
+        return False
+
+    def _set_low_latency_linux(self):
+        tty_name = os.path.basename(os.path.realpath(self.serial_object.port))
+        latency_timer_path = "/sys/bus/usb-serial/devices/{0}/latency_timer".format(tty_name)
+
+        if not os.path.exists(latency_timer_path):
+            return False
+
+        try:
+            with open(latency_timer_path, "w") as latency_timer:
+                latency_timer.write("1")
+        except OSError as err:
+            logger.warning("Could not lower the latency timer of %s: %s", self.serial_object.port, err)
+            return False
+
+        logger.debug("Latency timer of %s set to 1 ms", self.serial_object.port)
+        return True
+
+    def _set_low_latency_windows(self):
+        import winreg
+
+        ftdibus_path = "SYSTEM\\CurrentControlSet\\Enum\\FTDIBUS"
+
+        try:
+            ftdibus = winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, ftdibus_path)
+        except OSError:
+            return False  # no FTDI device was ever installed
+
+        with ftdibus:
+            index = 0
+            while True:
+                try:
+                    device = winreg.EnumKey(ftdibus, index)
+                except OSError:
+                    return False  # no more devices
+                index += 1
+
+                parameters_path = "{0}\\{1}\\0000\\Device Parameters".format(ftdibus_path, device)
+                try:
+                    with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, parameters_path) as parameters:
+                        port_name = winreg.QueryValueEx(parameters, "PortName")[0]
+                except OSError:
+                    continue
+
+                if port_name != self.serial_object.port:
+                    continue
+
+                try:
+                    with winreg.OpenKey(winreg.HKEY_LOCAL_MACHINE, parameters_path, 0, winreg.KEY_SET_VALUE) as parameters:
+                        winreg.SetValueEx(parameters, "LatencyTimer", 0, winreg.REG_DWORD, 1)
+                except OSError as err:
+                    logger.warning("Could not lower the latency timer of %s: %s", self.serial_object.port, err)
+                    return False
+
+                logger.debug("Latency timer of %s set to 1 ms (applies when the port is next opened)", self.serial_object.port)
+                return True
+
+    def set_buffer_size(self, rx_size, tx_size=None):
+        """
+        Enlarge the driver receive (and transmit) buffers of the serial port, so that a burst of incoming data does not
+        overflow them before it is read. Only supported on Windows, where the default receive buffer is 4096 bytes; other
+        platforms do not expose a per-port buffer size and are left untouched.
+
+        :param int rx_size: receive buffer size in bytes
+        :param int tx_size: transmit buffer size in bytes (the driver default is kept if None)
+        :rtype: bool
+        :return: True if the buffer sizes were set, False otherwise.
+        """
+        if sys.platform != "win32":
+            return False
+
+        try:
+            self.serial_object.set_buffer_size(rx_size=rx_size, tx_size=tx_size)
+        except (serial.SerialException, ValueError) as err:
+            logger.warning("Could not set the buffer sizes of %s: %s", self.serial_object.port, err)
+            return False
+
+        logger.debug("Buffer sizes of %s set to rx=%s, tx=%s", self.serial_object.port, rx_size, tx_size)
+        return True
+
     def close(self):
         """
         Close serial connection
@@ -182,11 +334,36 @@ class ArCOM(object):
     ##############################################################
 
     def read_bytes_array(self, array_len=1):
-        message_array = []
-        for pos in range(0, array_len):
-            message_bytes = self.read_byte()
-            message_array.append(message_bytes)
-        return message_array
+        """
+        Read array_len bytes as a single bytes object.
+
+        :param int array_len: number of bytes to read
+        :rtype: bytes
+        """
+        return self.read_exactly(array_len)
+
+    def read_exactly(self, size):
+        """
+        Read exactly size bytes, looping over short reads until the requested amount is received.
+
+        pyserial's read() may return fewer bytes than requested when the port times out. Instead of
+        giving up on the first short read, keep reading until a deadline that allows one port timeout
+        for each USB packet spanned by the message, so that slow USB serial adapters do not abort mid-message.
+
+        :param int size: number of bytes to read
+        :rtype: bytes
+        :return: Bytes read. May be shorter than size if the deadline expired.
+        """
+        message_bytes = self.serial_object.read(size)
+        timeout = self.serial_object.timeout
+
+        if len(message_bytes) < size and timeout:
+            n_packets = -(-size // USB_PACKET_SIZE)
+            deadline = time.monotonic() + timeout * n_packets
+            while len(message_bytes) < size and time.monotonic() < deadline:
+                message_bytes += self.serial_object.read(size - len(message_bytes))
+
+        return message_bytes
 
     def read_char_array(self, array_len=1):
         message_array = []
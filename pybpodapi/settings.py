@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import logging
+import os
 
 PYBPOD_API_LOG_LEVEL = None  #logging.DEBUG
 PYBPOD_API_LOG_FILE = "pybpod-api.log"
@@ -30,6 +31,9 @@ PYBPOD_BAUDRATE = 1312500
 PYBPOD_SYNC_CHANNEL = 255
 PYBPOD_SYNC_MODE = 1
 
+# file where the Bpod r2+ serial ports found on this machine are cached between runs (None disables the cache)
+PYBPOD_PORT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".pybpodapi", "port_cache.json")
+
 
 BPOD_BNC_PORTS_ENABLED = [True, True]
 BPOD_WIRED_PORTS_ENABLED = [True, True]